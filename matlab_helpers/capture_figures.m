@@ -0,0 +1,31 @@
+function pngs = capture_figures()
+%CAPTURE_FIGURES Encode every open figure as PNG bytes without touching disk.
+%   PNGS = CAPTURE_FIGURES() returns a 1-by-N cell array holding one uint8
+%   row vector of PNG data per open figure, in ascending figure-number
+%   order (figures without an integer number come last).
+%
+%   The PNG encoding is done by Java, so an error with identifier
+%   'capture_figures:noJava' is raised when MATLAB runs without a JVM.
+
+if ~usejava('jvm')
+    error('capture_figures:noJava', 'Encoding figures in memory requires Java.');
+end
+
+figs = list_figures();
+
+pngs = cell(1, numel(figs));
+for k = 1:numel(figs)
+    rgb = print(figs{k}, '-RGBImage');
+    [h, w, ~] = size(rgb);
+    pixels = bitshift(uint32(rgb(:, :, 1)), 16) + ...
+             bitshift(uint32(rgb(:, :, 2)), 8) + ...
+             uint32(rgb(:, :, 3));
+
+    img = java.awt.image.BufferedImage(w, h, java.awt.image.BufferedImage.TYPE_INT_RGB);
+    img.setRGB(0, 0, w, h, typecast(reshape(pixels.', 1, []), 'int32'), 0, w);
+
+    stream = java.io.ByteArrayOutputStream();
+    javax.imageio.ImageIO.write(img, 'png', stream);
+    pngs{k} = reshape(typecast(stream.toByteArray(), 'uint8'), 1, []);
+end
+end
@@ -0,0 +1,12 @@
+function ws = get_workspace_struct()
+%GET_WORKSPACE_STRUCT Pack every base workspace variable into one struct.
+%   WS = GET_WORKSPACE_STRUCT() returns a scalar struct with one field per
+%   variable in the base workspace, so the whole workspace crosses the
+%   engine boundary in a single call.
+
+names = evalin('base', 'who');
+ws = struct();
+for k = 1:numel(names)
+    ws.(names{k}) = evalin('base', names{k});
+end
+end
@@ -0,0 +1,16 @@
+function figs = list_figures()
+%LIST_FIGURES Return every open figure, ordered by figure number.
+%   FIGS = LIST_FIGURES() returns a 1-by-N cell array holding one figure
+%   handle per open figure, in ascending figure-number order (figures
+%   without an integer number come last). A cell array lets the handles
+%   cross the engine boundary one scalar object at a time.
+
+handles = findobj(groot, '-depth', 1, 'Type', 'figure');
+if ~isempty(handles)
+    numbers = get(handles, {'Number'});
+    numbers(cellfun(@isempty, numbers)) = {Inf};
+    [~, order] = sort(cell2mat(numbers));
+    handles = handles(order);
+end
+figs = reshape(num2cell(handles), 1, []);
+end
@@ -5,10 +5,15 @@ Modified to work in WSL by using MATLAB command line instead of MATLAB Engine
 """
 
 import asyncio
+import atexit
 import json
 import os
+import queue
+import re
 import subprocess
 import sys
+import threading
+import time
 from pathlib import Path
 from typing import Dict, Any, List, Optional
 
@@ -20,14 +25,255 @@ from mcp.server.models import InitializationOptions
 # Configuration
 MATLAB_PATH = os.getenv("MATLAB_PATH", "/mnt/c/Program Files/MATLAB/R2024a")
 MATLAB_EXECUTABLE = os.path.join(MATLAB_PATH, "bin", "matlab.exe")
+_MATLAB_OK = os.path.exists(MATLAB_EXECUTABLE)
 
 # Create a directory for MATLAB scripts if it doesn't exist
 MATLAB_DIR = Path("matlab_scripts")
 MATLAB_DIR.mkdir(exist_ok=True)
 
-def run_matlab_command(command: str, script_path: Optional[str] = None) -> Dict[str, Any]:
+# Valid MATLAB identifier: a letter, then letters, digits or underscores, at
+# most namelengthmax (63) characters
+_IDENT_RE = re.compile(r'\A[A-Za-z][A-Za-z0-9_]{0,62}\Z')
+
+def write_matlab_file(path: Path, code: str):
+    """Write a .m file through a single raw file descriptor."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        data = memoryview(code.encode())
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+# Worker pool configuration; the Windows launcher (matlab.exe) does not hand
+# its stdin to MATLAB, so the pool is off by default there
+_WINDOWS_LAUNCHER = MATLAB_EXECUTABLE.lower().endswith(".exe")
+MATLAB_POOL_SIZE = int(os.getenv("MATLAB_POOL_SIZE", "0" if _WINDOWS_LAUNCHER else "2"))
+MATLAB_TIMEOUT = 60
+MATLAB_STARTUP_TIMEOUT = 120
+
+# Delimiters written around each command sent to a worker
+START_MARKER = "<<<START_OUT>>>"
+ERROR_MARKER = "<<<START_ERR>>>"
+END_MARKER_RE = re.compile(r"<<<END_EXEC:(\d+)>>>")
+
+def matlab_string(text: str) -> str:
+    """Quote text as a MATLAB char expression, keeping its line breaks."""
+    lines = text.replace("\r", "").split("\n")
+    return "[" + " char(10) ".join("'" + line.replace("'", "''") + "'" for line in lines) + "]"
+
+class MatlabWorkerProcess:
+    """A long-lived MATLAB REPL process driven through stdin/stdout."""
+
+    def __init__(self):
+        # -wait keeps the Windows launcher attached to the MATLAB it starts
+        args = [MATLAB_EXECUTABLE, "-nodesktop", "-nosplash"]
+        if _WINDOWS_LAUNCHER:
+            args.append("-wait")
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0
+        )
+        # stdout is drained by a background thread so reads can time out
+        self.lines: queue.Queue = queue.Queue()
+        self.reader = threading.Thread(target=self._read_stdout, daemon=True)
+        self.reader.start()
+        # Set once MATLAB has answered its first command
+        self.ready = False
+
+    def _read_stdout(self):
+        for line in iter(self.process.stdout.readline, b""):
+            self.lines.put(line.decode(errors="replace"))
+        self.lines.put(None)
+
+    def _next_line(self, deadline: float) -> str:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError
+        try:
+            line = self.lines.get(timeout=remaining)
+        except queue.Empty:
+            raise TimeoutError
+        if line is None:
+            raise RuntimeError("MATLAB worker process exited")
+        return line
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def execute(self, command: str) -> Dict[str, Any]:
+        """
+        Run a command in the worker and read its output up to the end delimiter.
+        
+        Args:
+            command: MATLAB command to run
+            
+        Returns:
+            Dictionary with output, error, and success status
+        """
+        output: List[str] = []
+        error: List[str] = []
+        if self.ready:
+            timeout = MATLAB_TIMEOUT
+            timeout_error = f"MATLAB command timed out after {MATLAB_TIMEOUT} seconds"
+        else:
+            # The first command also waits for MATLAB itself to start
+            timeout = MATLAB_STARTUP_TIMEOUT
+            timeout_error = f"MATLAB worker did not start within {MATLAB_STARTUP_TIMEOUT} seconds"
+        try:
+            # The command is passed to eval() as a string, so syntax errors and
+            # unclosed blocks are caught below instead of stalling the REPL.
+            # The worker returns to its start folder after every command.
+            self.process.stdin.write((
+                ("" if self.ready else "setenv('MCP_START_DIR', pwd);\n") +
+                f"try\n"
+                f"disp('{START_MARKER}');\n"
+                f"eval({matlab_string(command)});\n"
+                f"cd(getenv('MCP_START_DIR')); disp('<<<END_EXEC:0>>>');\n"
+                f"catch mcp_err\n"
+                f"cd(getenv('MCP_START_DIR'));\n"
+                f"disp('{ERROR_MARKER}'); disp(mcp_err.message);\n"
+                f"disp('<<<END_EXEC:1>>>');\n"
+                f"end\n"
+            ).encode())
+            self.process.stdin.flush()
+            
+            # Skip the startup banner and prompts left over from earlier commands
+            deadline = time.monotonic() + timeout
+            while START_MARKER not in self._next_line(deadline):
+                pass
+            
+            if not self.ready:
+                self.ready = True
+                timeout_error = f"MATLAB command timed out after {MATLAB_TIMEOUT} seconds"
+            current = output
+            deadline = time.monotonic() + MATLAB_TIMEOUT
+            while True:
+                line = self._next_line(deadline)
+                # Output without a trailing newline shares its last line
+                # with the marker that follows it
+                match = END_MARKER_RE.search(line)
+                if match:
+                    current.append(line[:match.start()])
+                    exit_code = int(match.group(1))
+                    break
+                if ERROR_MARKER in line:
+                    current.append(line[:line.index(ERROR_MARKER)])
+                    current = error
+                    continue
+                current.append(line)
+        except TimeoutError:
+            # The worker is stuck mid-command; kill it so the pool replaces it
+            self.kill()
+            return {
+                "output": "".join(output),
+                "error": timeout_error,
+                "success": False,
+                "return_code": -1
+            }
+        except Exception as e:
+            self.kill()
+            return {
+                "output": "".join(output),
+                "error": f"Error running MATLAB: {str(e)}",
+                "success": False,
+                "return_code": -1
+            }
+        
+        return {
+            "output": "".join(output),
+            "error": "".join(error),
+            "success": exit_code == 0,
+            "return_code": exit_code
+        }
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+    def shutdown(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.write(b"exit\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=10)
+            except Exception:
+                self.kill()
+
+class MatlabProcessPool:
+    """Pool of pre-warmed MATLAB workers; each request borrows one worker."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.idle: queue.Queue = queue.Queue()
+        self.workers: List[MatlabWorkerProcess] = []
+        self.lock = threading.Lock()
+
+    def _spawn(self) -> MatlabWorkerProcess:
+        worker = MatlabWorkerProcess()
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def start(self):
+        """Launch all workers so MATLAB initializes in the background."""
+        for _ in range(self.size):
+            self.idle.put(self._spawn())
+        atexit.register(self.shutdown)
+
+    def execute(self, command: str) -> Dict[str, Any]:
+        """Run a command on an idle worker, replacing the worker if it died."""
+        worker = self.idle.get()
+        try:
+            if worker is None:
+                # An earlier replacement failed to start; try again now
+                worker = self._spawn()
+            return worker.execute(command)
+        except Exception as e:
+            return {
+                "output": "",
+                "error": f"Error starting MATLAB: {str(e)}",
+                "success": False,
+                "return_code": -1
+            }
+        finally:
+            if worker is not None and not worker.is_alive():
+                with self.lock:
+                    self.workers.remove(worker)
+                # A worker that never answered is not replaced right away, so
+                # a MATLAB that cannot be driven is not launched over and over
+                replacement = None
+                if worker.ready:
+                    try:
+                        replacement = self._spawn()
+                    except Exception:
+                        pass
+                worker = replacement
+            # Always hand a slot back, so the pool never shrinks for good
+            self.idle.put(worker)
+
+    def shutdown(self):
+        with self.lock:
+            workers = list(self.workers)
+            self.workers.clear()
+        for worker in workers:
+            worker.shutdown()
+
+# Pool used by run_matlab_command; started in __main__
+pool: Optional[MatlabProcessPool] = None
+
+async def read_stream(stream: asyncio.StreamReader, chunks: List[bytes]):
+    """Append everything read from a subprocess pipe to chunks as it arrives."""
+    while chunk := await stream.read(65536):
+        chunks.append(chunk)
+
+async def run_matlab_command(command: str, script_path: Optional[str] = None) -> Dict[str, Any]:
     """
-    Run a MATLAB command using subprocess.
+    Run a MATLAB command, using the worker pool when it is running and a
+    one-shot `matlab -batch` subprocess otherwise.
     
     Args:
         command: MATLAB command to run
@@ -36,34 +282,66 @@ def run_matlab_command(command: str, script_path: Optional[str] = None) -> Dict[
     Returns:
         Dictionary with output, error, and success status
     """
+    if not _MATLAB_OK:
+        return {
+            "output": "",
+            "error": f"MATLAB executable not found at {MATLAB_EXECUTABLE}",
+            "success": False,
+            "return_code": -1
+        }
+    
+    if pool is not None:
+        if script_path:
+            # run() changes into the script directory and back again; the
+            # path is relative to the worker's start folder, which every
+            # command returns to
+            return await asyncio.to_thread(pool.execute, f"run({matlab_string(script_path)})")
+        return await asyncio.to_thread(pool.execute, command)
+    
+    process = None
+    stdout: List[bytes] = []
+    stderr: List[bytes] = []
     try:
-        # Prepare the full command
+        # Prepare the MATLAB arguments; -batch exits on its own when done
         if script_path:
-            # For script execution, change to the script directory and run
+            # For script execution, start MATLAB in the script directory and
+            # run the script by name
             script_dir = os.path.dirname(script_path)
             script_name = os.path.basename(script_path).replace('.m', '')
-            full_command = f"cd('{script_dir}'); {script_name}; exit"
+            matlab_args = ["-sd", script_dir, "-batch", script_name]
         else:
-            full_command = f"{command}; exit"
+            matlab_args = ["-batch", command]
         
         # Run MATLAB with the command
-        result = subprocess.run(
-            [MATLAB_EXECUTABLE, "-batch", full_command],
-            capture_output=True,
-            text=True,
-            timeout=60  # 60 second timeout
+        process = await asyncio.create_subprocess_exec(
+            MATLAB_EXECUTABLE, *matlab_args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
+        # Read output incrementally so it is still available after a timeout
+        async with asyncio.timeout(MATLAB_TIMEOUT):
+            await asyncio.gather(
+                read_stream(process.stdout, stdout),
+                read_stream(process.stderr, stderr),
+                process.wait()
+            )
         
         return {
-            "output": result.stdout,
-            "error": result.stderr,
-            "success": result.returncode == 0,
-            "return_code": result.returncode
+            "output": b"".join(stdout).decode(errors="replace"),
+            "error": b"".join(stderr).decode(errors="replace"),
+            "success": process.returncode == 0,
+            "return_code": process.returncode
         }
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
         return {
-            "output": "",
-            "error": "MATLAB command timed out after 60 seconds",
+            "output": b"".join(stdout).decode(errors="replace"),
+            "error": f"MATLAB command timed out after {MATLAB_TIMEOUT} seconds",
             "success": False,
             "return_code": -1
         }
@@ -74,79 +352,100 @@ def run_matlab_command(command: str, script_path: Optional[str] = None) -> Dict[
             "success": False,
             "return_code": -1
         }
+    finally:
+        # A cancelled call (or any other early exit) must not leave MATLAB running
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+
+def format_matlab_result(header: str, result: Dict[str, Any]) -> str:
+    """Build the tool response text for a run_matlab_command result."""
+    parts = [header, ""]
+    if result["success"]:
+        parts += ["Output:", result["output"]]
+        if result["error"]:
+            parts += ["", "Warnings/Messages:", result["error"]]
+    else:
+        parts += [f"Error (Return code: {result['return_code']}):", result["error"]]
+        if result["output"]:
+            parts += ["", "Output:", result["output"]]
+    return "\n".join(parts)
 
 # Initialize the MCP server
 server = Server("matlab-server")
 
+# Tool definitions never change, so they are built once at import
+_TOOLS_CACHE = [
+    types.Tool(
+        name="create_matlab_script",
+        description="Create a new MATLAB script file",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "script_name": {
+                    "type": "string",
+                    "description": "Name of the script (without .m extension)"
+                },
+                "code": {
+                    "type": "string",
+                    "description": "MATLAB code to save"
+                }
+            },
+            "required": ["script_name", "code"]
+        }
+    ),
+    types.Tool(
+        name="create_matlab_function",
+        description="Create a new MATLAB function file",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "function_name": {
+                    "type": "string",
+                    "description": "Name of the function (without .m extension)"
+                },
+                "code": {
+                    "type": "string",
+                    "description": "MATLAB function code"
+                }
+            },
+            "required": ["function_name", "code"]
+        }
+    ),
+    types.Tool(
+        name="execute_matlab_command",
+        description="Execute a MATLAB command directly",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "command": {
+                    "type": "string",
+                    "description": "MATLAB command to execute"
+                }
+            },
+            "required": ["command"]
+        }
+    ),
+    types.Tool(
+        name="execute_matlab_script",
+        description="Execute a MATLAB script and return results",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "script_name": {
+                    "type": "string",
+                    "description": "Name of the script to execute (without .m extension)"
+                }
+            },
+            "required": ["script_name"]
+        }
+    )
+]
+
 @server.list_tools()
 async def handle_list_tools() -> list[types.Tool]:
     """List available MATLAB tools."""
-    return [
-        types.Tool(
-            name="create_matlab_script",
-            description="Create a new MATLAB script file",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "script_name": {
-                        "type": "string",
-                        "description": "Name of the script (without .m extension)"
-                    },
-                    "code": {
-                        "type": "string",
-                        "description": "MATLAB code to save"
-                    }
-                },
-                "required": ["script_name", "code"]
-            }
-        ),
-        types.Tool(
-            name="create_matlab_function",
-            description="Create a new MATLAB function file",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "function_name": {
-                        "type": "string",
-                        "description": "Name of the function (without .m extension)"
-                    },
-                    "code": {
-                        "type": "string",
-                        "description": "MATLAB function code"
-                    }
-                },
-                "required": ["function_name", "code"]
-            }
-        ),
-        types.Tool(
-            name="execute_matlab_command",
-            description="Execute a MATLAB command directly",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "command": {
-                        "type": "string",
-                        "description": "MATLAB command to execute"
-                    }
-                },
-                "required": ["command"]
-            }
-        ),
-        types.Tool(
-            name="execute_matlab_script",
-            description="Execute a MATLAB script and return results",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "script_name": {
-                        "type": "string",
-                        "description": "Name of the script to execute (without .m extension)"
-                    }
-                },
-                "required": ["script_name"]
-            }
-        )
-    ]
+    return _TOOLS_CACHE
 
 @server.call_tool()
 async def handle_call_tool(name: str, arguments: dict) -> list[types.TextContent]:
@@ -157,7 +456,7 @@ async def handle_call_tool(name: str, arguments: dict) -> list[types.TextContent
         code = arguments["code"]
         
         # Validate script name
-        if not script_name.replace('_', '').isalnum():
+        if not _IDENT_RE.match(script_name):
             return [types.TextContent(
                 type="text",
                 text=f"Error: Script name '{script_name}' must be a valid MATLAB identifier"
@@ -166,7 +465,7 @@ async def handle_call_tool(name: str, arguments: dict) -> list[types.TextContent
         # Create script file
         script_path = MATLAB_DIR / f"{script_name}.m"
         try:
-            script_path.write_text(code)
+            write_matlab_file(script_path, code)
             return [types.TextContent(
                 type="text",
                 text=f"Created MATLAB script: {script_path.absolute()}"
@@ -182,7 +481,7 @@ async def handle_call_tool(name: str, arguments: dict) -> list[types.TextContent
         code = arguments["code"]
         
         # Validate function name
-        if not function_name.replace('_', '').isalnum():
+        if not _IDENT_RE.match(function_name):
             return [types.TextContent(
                 type="text",
                 text=f"Error: Function name '{function_name}' must be a valid MATLAB identifier"
@@ -191,7 +490,7 @@ async def handle_call_tool(name: str, arguments: dict) -> list[types.TextContent
         # Create function file
         function_path = MATLAB_DIR / f"{function_name}.m"
         try:
-            function_path.write_text(code)
+            write_matlab_file(function_path, code)
             return [types.TextContent(
                 type="text",
                 text=f"Created MATLAB function: {function_path.absolute()}"
@@ -205,19 +504,12 @@ async def handle_call_tool(name: str, arguments: dict) -> list[types.TextContent
     elif name == "execute_matlab_command":
         command = arguments["command"]
         
-        result = run_matlab_command(command)
-        
-        response = f"MATLAB Command: {command}\n\n"
-        if result["success"]:
-            response += f"Output:\n{result['output']}"
-            if result["error"]:
-                response += f"\n\nWarnings/Messages:\n{result['error']}"
-        else:
-            response += f"Error (Return code: {result['return_code']}):\n{result['error']}"
-            if result["output"]:
-                response += f"\n\nOutput:\n{result['output']}"
+        result = await run_matlab_command(command)
         
-        return [types.TextContent(type="text", text=response)]
+        return [types.TextContent(
+            type="text",
+            text=format_matlab_result(f"MATLAB Command: {command}", result)
+        )]
     
     elif name == "execute_matlab_script":
         script_name = arguments["script_name"]
@@ -229,19 +521,12 @@ async def handle_call_tool(name: str, arguments: dict) -> list[types.TextContent
                 text=f"Error: Script '{script_name}.m' not found in {MATLAB_DIR}"
             )]
         
-        result = run_matlab_command("", str(script_path))
-        
-        response = f"Executed MATLAB script: {script_name}.m\n\n"
-        if result["success"]:
-            response += f"Output:\n{result['output']}"
-            if result["error"]:
-                response += f"\n\nWarnings/Messages:\n{result['error']}"
-        else:
-            response += f"Error (Return code: {result['return_code']}):\n{result['error']}"
-            if result["output"]:
-                response += f"\n\nOutput:\n{result['output']}"
+        result = await run_matlab_command("", str(script_path))
         
-        return [types.TextContent(type="text", text=response)]
+        return [types.TextContent(
+            type="text",
+            text=format_matlab_result(f"Executed MATLAB script: {script_name}.m", result)
+        )]
     
     else:
         return [types.TextContent(
@@ -267,13 +552,25 @@ async def main():
 
 if __name__ == "__main__":
     # Test MATLAB availability
-    if not os.path.exists(MATLAB_EXECUTABLE):
+    if not _MATLAB_OK:
         print(f"Error: MATLAB executable not found at {MATLAB_EXECUTABLE}", file=sys.stderr)
         print("Please set MATLAB_PATH environment variable", file=sys.stderr)
         sys.exit(1)
     
+    # Start the worker pool
+    if MATLAB_POOL_SIZE > 0:
+        pool = MatlabProcessPool(MATLAB_POOL_SIZE)
+        pool.start()
+    
     # Test MATLAB execution
-    test_result = run_matlab_command("disp('MATLAB MCP Server Ready')")
+    test_result = asyncio.run(run_matlab_command("disp('MATLAB MCP Server Ready')"))
+    if not test_result["success"] and pool is not None:
+        # The MATLAB REPL could not be driven over stdin (e.g. a detached
+        # launcher), so fall back to one-shot -batch processes
+        print(f"Warning: MATLAB worker pool unavailable: {test_result['error']}", file=sys.stderr)
+        pool.shutdown()
+        pool = None
+        test_result = asyncio.run(run_matlab_command("disp('MATLAB MCP Server Ready')"))
     if not test_result["success"]:
         print(f"Error: Unable to run MATLAB: {test_result['error']}", file=sys.stderr)
         sys.exit(1)
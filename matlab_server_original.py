@@ -1,8 +1,12 @@
+import asyncio
+import atexit
 import os
+import re
 from pathlib import Path
 import base64
 import subprocess
 import sys
+import tempfile
 from typing import Optional, Dict, Any
 from mcp.server.fastmcp import FastMCP, Image, Context
 import io
@@ -56,15 +60,121 @@ def ensure_matlab_engine():
                 "Please try installing manually or check your MATLAB installation."
             )
 
-# Try to initialize MATLAB engine
-ensure_matlab_engine()
-import matlab.engine
-eng = matlab.engine.start_matlab()
+# Installing the MATLAB engine is opt-in; normal startup imports it directly
+if "--install-engine" in sys.argv:
+    ensure_matlab_engine()
+try:
+    import matlab.engine
+except ImportError:
+    raise RuntimeError(
+        "MATLAB engine for Python is not installed. "
+        "Run the server once with --install-engine to install it from MATLAB_PATH."
+    ) from None
 
 # Create a directory for MATLAB scripts if it doesn't exist
 MATLAB_DIR = Path("matlab_scripts")
 MATLAB_DIR.mkdir(exist_ok=True)
 
+# Resolve the directory once so every path handed to the engines is absolute
+# and keeps working after a cd in either Python or MATLAB
+MATLAB_DIR = MATLAB_DIR.resolve()
+_MATLAB_DIR_STR = str(MATLAB_DIR)
+
+# Start every engine of the pool concurrently at import, so no request pays
+# the MATLAB cold start
+MATLAB_POOL_SIZE = max(1, int(os.getenv('MATLAB_POOL_SIZE', '2')))
+engine_futures = [matlab.engine.start_matlab(background=True) for _ in range(MATLAB_POOL_SIZE)]
+engines = [future.result() for future in engine_futures]
+
+# MATLAB helper functions shipped alongside this server; their names cannot
+# be used for user scripts and functions
+HELPERS_DIR = Path(__file__).resolve().parent / "matlab_helpers"
+_HELPER_NAMES = frozenset(path.stem for path in HELPERS_DIR.glob("*.m"))
+
+# Register the helper and script directories once per engine, not per call;
+# the helpers come first so user files can never shadow them
+for engine in engines:
+    engine.addpath(str(HELPERS_DIR), _MATLAB_DIR_STR, nargout=0)
+
+idle_engines: asyncio.Queue = asyncio.Queue()
+for engine in engines:
+    idle_engines.put_nowait(engine)
+
+@atexit.register
+def shutdown_engines():
+    """Quit every MATLAB engine of the pool."""
+    for engine in engines:
+        try:
+            engine.quit()
+        except Exception:
+            pass
+
+async def run_on_engine(func, *args):
+    """
+    Borrow an idle MATLAB engine and run func(engine, *args) on it in a
+    worker thread, so the event loop stays free for other tool calls.
+    
+    The engine goes back to the pool only when the thread is done with it,
+    even if the tool call is cancelled while it runs.
+    """
+    eng = await idle_engines.get()
+    future = asyncio.get_running_loop().run_in_executor(None, func, eng, *args)
+    
+    def release(done):
+        if not done.cancelled():
+            done.exception()  # retrieved here in case the caller is gone
+        idle_engines.put_nowait(eng)
+    
+    future.add_done_callback(release)
+    return await asyncio.shield(future)
+
+def capture_figures(eng) -> list:
+    """Return every open figure as a PNG image, in one engine round-trip."""
+    try:
+        buffers = eng.feval('capture_figures', nargout=1)
+    except matlab.engine.MatlabExecutionError:
+        # No JVM to encode PNGs in memory, so go through files instead
+        return save_figures(eng)
+    return [Image(data=bytes(buffer[0]), format='png') for buffer in buffers]
+
+def save_figures(eng) -> list:
+    """Return every open figure as a PNG image by saving each one to a file."""
+    figures = []
+    # The open figure handles, in the same order capture_figures uses
+    for fig in eng.feval('list_figures', nargout=1):
+        # Save figure to a uniquely named file in the system temp dir, so
+        # concurrent calls on other engines cannot collide
+        fd, temp_file = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+        try:
+            eng.feval('saveas', fig, temp_file, nargout=0)
+            
+            # Read the file back
+            with open(temp_file, 'rb') as f:
+                img_data = f.read()
+            figures.append(Image(data=img_data, format='png'))
+        finally:
+            # Clean up temp file
+            os.unlink(temp_file)
+    return figures
+
+# Valid MATLAB identifier: a letter, then letters, digits or underscores, at
+# most namelengthmax (63) characters
+_IDENT_RE = re.compile(r'\A[A-Za-z][A-Za-z0-9_]{0,62}\Z')
+
+# Engines that may still have figures open from an earlier call
+figures_open = set()
+
+def write_matlab_file(path: Path, code: str):
+    """Write a .m file through a single raw file descriptor."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        data = memoryview(code.encode())
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
 @mcp.tool()
 def create_matlab_script(script_name: str, code: str) -> str:
     """Create a new MATLAB script file.
@@ -76,12 +186,13 @@ def create_matlab_script(script_name: str, code: str) -> str:
     Returns:
         Path to the created script
     """
-    if not script_name.isidentifier():
+    if not _IDENT_RE.match(script_name):
         raise ValueError("Script name must be a valid MATLAB identifier")
+    if script_name in _HELPER_NAMES:
+        raise ValueError(f"Script name '{script_name}' is reserved by the server")
     
     script_path = MATLAB_DIR / f"{script_name}.m"
-    with open(script_path, 'w') as f:
-        f.write(code)
+    write_matlab_file(script_path, code)
     
     return str(script_path)
 
@@ -96,34 +207,41 @@ def create_matlab_function(function_name: str, code: str) -> str:
     Returns:
         Path to the created function file
     """
-    if not function_name.isidentifier():
+    if not _IDENT_RE.match(function_name):
         raise ValueError("Function name must be a valid MATLAB identifier")
+    if function_name in _HELPER_NAMES:
+        raise ValueError(f"Function name '{function_name}' is reserved by the server")
     
     # Verify code starts with function definition
     if not code.strip().startswith('function'):
         raise ValueError("Code must start with function definition")
     
     function_path = MATLAB_DIR / f"{function_name}.m"
-    with open(function_path, 'w') as f:
-        f.write(code)
+    write_matlab_file(function_path, code)
     
     return str(function_path)
 
 @mcp.tool()
-def execute_matlab_script(script_name: str, args: Optional[Dict[str, Any]] = None) -> dict:
+async def execute_matlab_script(script_name: str, args: Optional[Dict[str, Any]] = None) -> dict:
     """Execute a MATLAB script and return results."""
     script_path = MATLAB_DIR / f"{script_name}.m"
     if not script_path.exists():
         raise FileNotFoundError(f"Script {script_name}.m not found")
 
-    # Add script directory to MATLAB path
-    eng.addpath(str(MATLAB_DIR))
-    
-    # Clear previous figures
-    eng.close('all', nargout=0)
+    return await run_on_engine(run_matlab_script, script_name, args)
+
+def run_matlab_script(eng, script_name: str, args: Optional[Dict[str, Any]]) -> dict:
+    """Run a script on a borrowed engine and collect its output, figures and workspace."""
+    # Clear previous figures, skipping the round-trip when there are none;
+    # the engine counts as having figures until the capture below says not
+    if eng in figures_open:
+        eng.feval('close', 'all', nargout=0)
+    figures_open.add(eng)
     
-    # Create a temporary file for MATLAB output
-    temp_output_file = MATLAB_DIR / f"temp_output_{script_name}.txt"
+    # Create a per-call temporary file for MATLAB output, so concurrent calls
+    # on other engines never share a diary
+    fd, temp_output_file = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
     
     # Execute the script
     result = {}
@@ -135,47 +253,30 @@ def execute_matlab_script(script_name: str, args: Optional[Dict[str, Any]] = Non
             eng.workspace['args'] = matlab_args
         
         # Set up diary to capture output
-        eng.eval(f"diary('{temp_output_file}')", nargout=0)
+        eng.feval('diary', temp_output_file, nargout=0)
+        # Scripts cannot be invoked through feval, so this is the one call
+        # that still goes through the MATLAB parser
         eng.eval(script_name, nargout=0)
-        eng.eval("diary off", nargout=0)
+        eng.feval('diary', 'off', nargout=0)
         
         # Read captured output
-        if temp_output_file.exists():
-            with open(temp_output_file, 'r') as f:
-                printed_output = f.read().strip()
-            # Clean up temp file
-            os.remove(temp_output_file)
-        else:
-            printed_output = "No output captured"
+        with open(temp_output_file, 'r') as f:
+            printed_output = f.read().strip()
         
         result['printed_output'] = printed_output
         
         # Rest of your code for figures and workspace variables...
         
         # Capture figures if any were generated
-        figures = []
-        fig_handles = eng.eval('get(groot, "Children")', nargout=1)
-        if fig_handles:
-            for i, fig in enumerate(fig_handles):
-                # Save figure to temporary file
-                temp_file = f"temp_fig_{i}.png"
-                eng.eval(f"saveas(figure({i+1}), '{temp_file}')", nargout=0)
-                
-                # Read the file and convert to base64
-                with open(temp_file, 'rb') as f:
-                    img_data = f.read()
-                figures.append(Image(data=img_data, format='png'))
-                
-                # Clean up temp file
-                os.remove(temp_file)
-        
+        figures = capture_figures(eng)
         result['figures'] = figures
+        if not figures:
+            figures_open.discard(eng)
         
-        # Get workspace variables
-        var_names = eng.eval('who', nargout=1)
-        for var in var_names:
+        # Get workspace variables in a single engine round-trip
+        workspace = eng.feval('get_workspace_struct', nargout=1)
+        for var, val in workspace.items():
             if var != 'args':  # Skip the args we passed in
-                val = eng.workspace[var]
                 # Clean variable name for JSON compatibility
                 clean_var_name = var.strip().replace(' ', '_')       
   
@@ -190,24 +291,38 @@ def execute_matlab_script(script_name: str, args: Optional[Dict[str, Any]] = Non
         
     except Exception as e:
         raise RuntimeError(f"MATLAB execution error: {str(e)}")
+    finally:
+        # Close the diary even when the call failed, so MATLAB no longer holds
+        # the file when it is removed; a failure here must not hide the error
+        try:
+            eng.feval('diary', 'off', nargout=0)
+        except Exception:
+            pass
+        os.unlink(temp_output_file)
         
     return result
 
 @mcp.tool()
-def call_matlab_function(function_name: str, args: Any) -> dict:
+async def call_matlab_function(function_name: str, args: Any) -> dict:
     """Call a MATLAB function with arguments."""
     function_path = MATLAB_DIR / f"{function_name}.m"
     if not function_path.exists():
         raise FileNotFoundError(f"Function {function_name}.m not found")
 
-    # Add function directory to MATLAB path
-    eng.addpath(str(MATLAB_DIR))
-    
-    # Clear previous figures
-    eng.close('all', nargout=0)
+    return await run_on_engine(run_matlab_function, function_name, args)
+
+def run_matlab_function(eng, function_name: str, args: Any) -> dict:
+    """Call a function on a borrowed engine and collect its output and figures."""
+    # Clear previous figures, skipping the round-trip when there are none;
+    # the engine counts as having figures until the capture below says not
+    if eng in figures_open:
+        eng.feval('close', 'all', nargout=0)
+    figures_open.add(eng)
     
-    # Create a temporary file for MATLAB output
-    temp_output_file = MATLAB_DIR / f"temp_output_{function_name}.txt"
+    # Create a per-call temporary file for MATLAB output, so concurrent calls
+    # on other engines never share a diary
+    fd, temp_output_file = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
     
     # Convert Python arguments to MATLAB types
     matlab_args = []
@@ -222,47 +337,37 @@ def call_matlab_function(function_name: str, args: Any) -> dict:
     result = {}
     try:
         # Set up diary to capture output
-        eng.eval(f"diary('{temp_output_file}')", nargout=0)
+        eng.feval('diary', temp_output_file, nargout=0)
         
         # Call the function
         output = getattr(eng, function_name)(*matlab_args)
         
         # Turn off diary
-        eng.eval("diary off", nargout=0)
+        eng.feval('diary', 'off', nargout=0)
         
         # Read captured output
-        if temp_output_file.exists():
-            with open(temp_output_file, 'r') as f:
-                printed_output = f.read().strip()
-            # Clean up temp file
-            os.remove(temp_output_file)
-        else:
-            printed_output = "No output captured"
+        with open(temp_output_file, 'r') as f:
+            printed_output = f.read().strip()
             
         result['output'] = str(output)
         result['printed_output'] = printed_output
         
-        # Capture figures - rest of your code remains the same
-        figures = []
-        fig_handles = eng.eval('get(groot, "Children")', nargout=1)
-        if fig_handles:
-            for i, fig in enumerate(fig_handles):
-                # Save figure to temporary file
-                temp_file = f"temp_fig_{i}.png"
-                eng.eval(f"saveas(figure({i+1}), '{temp_file}')", nargout=0)
-                
-                # Read the file and convert to base64
-                with open(temp_file, 'rb') as f:
-                    img_data = f.read()
-                figures.append(Image(data=img_data, format='png'))
-                
-                # Clean up temp file
-                os.remove(temp_file)
-        
+        # Capture figures
+        figures = capture_figures(eng)
         result['figures'] = figures
+        if not figures:
+            figures_open.discard(eng)
         
     except Exception as e:
         raise RuntimeError(f"MATLAB execution error: {str(e)}")
+    finally:
+        # Close the diary even when the call failed, so MATLAB no longer holds
+        # the file when it is removed; a failure here must not hide the error
+        try:
+            eng.feval('diary', 'off', nargout=0)
+        except Exception:
+            pass
+        os.unlink(temp_output_file)
         
     return result
 
@@ -7,10 +7,10 @@ Modified to work in WSL by using MATLAB command line instead of MATLAB Engine
 import asyncio
 import json
 import os
-import subprocess
+import re
 import sys
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Callable, Dict, Any, List, Optional, Set
 
 import mcp.server.stdio
 import mcp.types as types
@@ -20,38 +20,91 @@ from mcp.server.models import InitializationOptions
 # Configuration
 MATLAB_PATH = os.getenv("MATLAB_PATH", "/mnt/c/Program Files/MATLAB/R2024a")
 MATLAB_EXECUTABLE = os.path.join(MATLAB_PATH, "bin", "matlab.exe")
+_MATLAB_OK = os.path.exists(MATLAB_EXECUTABLE)
 
 # Create a directory for MATLAB scripts if it doesn't exist
 MATLAB_DIR = Path("matlab_scripts")
 MATLAB_DIR.mkdir(exist_ok=True)
 
-def run_matlab_command(command: str, script_path: Optional[str] = None) -> Dict[str, Any]:
-    """Run a MATLAB command using subprocess."""
+# Time allowed for a single command
+MATLAB_TIMEOUT = 60
+
+async def read_stream(stream: asyncio.StreamReader, chunks: List[bytes],
+                      on_chunk: Optional[Callable[[], None]] = None):
+    """Append everything read from a subprocess pipe to chunks as it arrives."""
+    while chunk := await stream.read(65536):
+        chunks.append(chunk)
+        if on_chunk is not None:
+            on_chunk()
+
+async def run_matlab_command(command: str, script_path: Optional[str] = None,
+                             timeout: float = MATLAB_TIMEOUT,
+                             step_re: Optional[re.Pattern] = None) -> Dict[str, Any]:
+    """
+    Run a MATLAB command in a subprocess without blocking the event loop.
+    
+    When step_re is given, the timeout restarts each time a new match of it
+    appears in stdout, so it limits each step of the command rather than the
+    whole run.
+    """
+    if not _MATLAB_OK:
+        return {
+            "output": "",
+            "error": f"MATLAB executable not found at {MATLAB_EXECUTABLE}",
+            "success": False,
+            "return_code": -1
+        }
+    
+    process = None
+    stdout: List[bytes] = []
+    stderr: List[bytes] = []
     try:
         if script_path:
             script_dir = os.path.dirname(script_path)
             script_name = os.path.basename(script_path).replace('.m', '')
-            full_command = f"cd('{script_dir}'); {script_name}"
+            matlab_args = ["-sd", script_dir, "-batch", script_name]
         else:
-            full_command = command
+            matlab_args = ["-batch", command]
         
-        result = subprocess.run(
-            [MATLAB_EXECUTABLE, "-batch", full_command],
-            capture_output=True,
-            text=True,
-            timeout=60
+        process = await asyncio.create_subprocess_exec(
+            MATLAB_EXECUTABLE, *matlab_args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
+        # Read output incrementally so it is still available after a timeout
+        loop = asyncio.get_running_loop()
+        steps = 0
+        async with asyncio.timeout(timeout) as step_timeout:
+            def restart_timeout():
+                # Each new step gets the full timeout from the moment it starts
+                nonlocal steps
+                seen = len(step_re.findall(b"".join(stdout).decode(errors="replace")))
+                if seen > steps:
+                    steps = seen
+                    step_timeout.reschedule(loop.time() + timeout)
+            
+            await asyncio.gather(
+                read_stream(process.stdout, stdout, restart_timeout if step_re else None),
+                read_stream(process.stderr, stderr),
+                process.wait()
+            )
         
         return {
-            "output": result.stdout,
-            "error": result.stderr,
-            "success": result.returncode == 0,
-            "return_code": result.returncode
+            "output": b"".join(stdout).decode(errors="replace"),
+            "error": b"".join(stderr).decode(errors="replace"),
+            "success": process.returncode == 0,
+            "return_code": process.returncode
         }
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
         return {
-            "output": "",
-            "error": "MATLAB command timed out after 60 seconds",
+            "output": b"".join(stdout).decode(errors="replace"),
+            "error": f"MATLAB command timed out after {timeout:g} seconds",
             "success": False,
             "return_code": -1
         }
@@ -62,46 +115,192 @@ def run_matlab_command(command: str, script_path: Optional[str] = None) -> Dict[
             "success": False,
             "return_code": -1
         }
+    finally:
+        # A cancelled call (or any other early exit) must not leave MATLAB running
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+
+# Command batching: commands arriving within BATCH_WINDOW of each other share
+# one MATLAB process instead of paying the startup cost each
+BATCH_WINDOW = 0.01
+BATCH_MAX_SIZE = 16
+# Markers are printed on lines of their own, so they are found even after
+# output that does not end in a newline; the surrounding line breaks belong
+# to the marker
+COMMAND_MARKER_RE = re.compile(r"\r?\n<<<CMD:(\d+)>>>\r?\n")
+ERROR_MARKER_RE = re.compile(r"\r?\n<<<CMD_ERR>>>\r?\n")
+
+_batch_queue: Optional[asyncio.Queue] = None
+_batch_task: Optional[asyncio.Task] = None
+_running_batches: Set[asyncio.Task] = set()
+
+async def run_matlab_batch(commands: List[str]) -> List[Dict[str, Any]]:
+    """
+    Run several MATLAB commands in a single MATLAB process.
+    
+    Args:
+        commands: MATLAB commands to run, in order
+        
+    Returns:
+        One result dictionary per command
+    """
+    if len(commands) == 1:
+        return [await run_matlab_command(commands[0])]
+    
+    # The command is followed by a comma, not a semicolon, so results such as
+    # "x = 5" are displayed just as when the command runs on its own
+    full_command = " ".join(
+        f"fprintf('\\n<<<CMD:{i}>>>\\n'); "
+        f"try, {command}, catch mcp_err, fprintf('\\n<<<CMD_ERR>>>\\n'); disp(mcp_err.message); end;"
+        for i, command in enumerate(commands)
+    )
+    # Each command gets the usual timeout, counted from its own marker
+    batch_result = await run_matlab_command(full_command, step_re=COMMAND_MARKER_RE)
+    output = batch_result["output"]
+    
+    markers = []
+    for marker in COMMAND_MARKER_RE.finditer(output):
+        if int(marker.group(1)) != len(markers):
+            break
+        markers.append(marker)
+    
+    if not markers:
+        if batch_result["return_code"] == -1:
+            # MATLAB could not be run or timed out before any command started
+            return [dict(batch_result) for _ in commands]
+        # MATLAB rejected the batch before running anything (e.g. a syntax
+        # error in one command), so run each command on its own to attribute
+        # the failure
+        return [await run_matlab_command(command) for command in commands]
+    
+    results = []
+    for i in range(len(commands)):
+        if i >= len(markers):
+            # The batch ended (timeout, exit or crash) before this command ran
+            results.append({
+                "output": "",
+                "error": f"Not run: MATLAB stopped during an earlier command in the same batch\n"
+                         f"{batch_result['error']}",
+                "success": False,
+                "return_code": -1
+            })
+            continue
+        
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(output)
+        segment = output[markers[i].end():end]
+        error = ""
+        error_marker = ERROR_MARKER_RE.search(segment)
+        if error_marker:
+            segment, error = segment[:error_marker.start()], segment[error_marker.end():]
+        if i + 1 == len(markers) and not batch_result["success"]:
+            # MATLAB stopped while running this command
+            results.append({
+                "output": segment,
+                "error": error or batch_result["error"],
+                "success": False,
+                "return_code": batch_result["return_code"]
+            })
+            continue
+        
+        # stderr of a batch cannot be attributed to a single command, so a
+        # command only reports the error it raised itself
+        results.append({
+            "output": segment,
+            "error": error,
+            "success": not error,
+            "return_code": 1 if error else 0
+        })
+    return results
+
+async def _run_batch(batch: List[tuple]):
+    """Run one batch and resolve the future of each queued command."""
+    try:
+        results = await run_matlab_batch([command for command, _ in batch])
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    # A caller may have given up (cancelled) while the batch was running
+    for (_, future), result in zip(batch, results):
+        if not future.done():
+            future.set_result(result)
+
+async def _process_batches(batch_queue: asyncio.Queue):
+    """Collect queued commands into batches and run each batch once."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(batch) < BATCH_MAX_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        # Run the batch in its own task so the next one can be collected
+        # while MATLAB is busy
+        task = asyncio.create_task(_run_batch(batch))
+        _running_batches.add(task)
+        task.add_done_callback(_running_batches.discard)
+
+async def submit_matlab_command(command: str) -> Dict[str, Any]:
+    """Queue a MATLAB command for the next batch and wait for its result."""
+    global _batch_queue, _batch_task
+    if _batch_queue is None:
+        _batch_queue = asyncio.Queue()
+        _batch_task = asyncio.create_task(_process_batches(_batch_queue))
+    
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((command, future))
+    return await future
 
 # Initialize the MCP server
 server = Server("matlab-server")
 
+# Tool definitions never change, so they are built once at import
+_TOOLS_CACHE = [
+    types.Tool(
+        name="execute_matlab_command",
+        description="Execute a MATLAB command directly",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "command": {
+                    "type": "string",
+                    "description": "MATLAB command to execute"
+                }
+            },
+            "required": ["command"]
+        }
+    )
+]
+
 @server.list_tools()
 async def handle_list_tools() -> list[types.Tool]:
     """List available MATLAB tools."""
-    return [
-        types.Tool(
-            name="execute_matlab_command",
-            description="Execute a MATLAB command directly",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "command": {
-                        "type": "string",
-                        "description": "MATLAB command to execute"
-                    }
-                },
-                "required": ["command"]
-            }
-        )
-    ]
+    return _TOOLS_CACHE
 
 @server.call_tool()
 async def handle_call_tool(name: str, arguments: dict) -> list[types.TextContent]:
     """Handle tool calls."""
     if name == "execute_matlab_command":
         command = arguments["command"]
-        result = run_matlab_command(command)
+        result = await submit_matlab_command(command)
         
-        response = f"MATLAB Command: {command}\n\n"
+        parts = [f"MATLAB Command: {command}", ""]
         if result["success"]:
-            response += f"Output:\n{result['output']}"
+            parts += ["Output:", result["output"]]
             if result["error"]:
-                response += f"\n\nWarnings:\n{result['error']}"
+                parts += ["", "Warnings:", result["error"]]
         else:
-            response += f"Error:\n{result['error']}"
+            parts += ["Error:", result["error"]]
         
-        return [types.TextContent(type="text", text=response)]
+        return [types.TextContent(type="text", text="\n".join(parts))]
     else:
         return [types.TextContent(type="text", text=f"Unknown tool: {name}")]
 
@@ -121,11 +320,11 @@ async def main():
         )
 
 if __name__ == "__main__":
-    if not os.path.exists(MATLAB_EXECUTABLE):
+    if not _MATLAB_OK:
         print(f"Error: MATLAB executable not found at {MATLAB_EXECUTABLE}", file=sys.stderr)
         sys.exit(1)
     
-    test_result = run_matlab_command("disp('MATLAB MCP Server Ready')")
+    test_result = asyncio.run(run_matlab_command("disp('MATLAB MCP Server Ready')"))
     if not test_result["success"]:
         print(f"Error: Unable to run MATLAB: {test_result['error']}", file=sys.stderr)
         sys.exit(1)